@@ -1,59 +1,389 @@
+import hashlib
+import logging
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
-from fastapi import FastAPI, Request, Form, HTTPException, status
-from fastapi.responses import HTMLResponse, RedirectResponse
+import secrets
+import stat
+from mimetypes import guess_type
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+from uuid import uuid4
+from fastapi import FastAPI, Request, Form, HTTPException, Depends, status
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
+from starlette.staticfiles import NotModifiedResponse
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.types import Scope
 from fastapi.templating import Jinja2Templates
-from starlette.middleware.sessions import SessionMiddleware
-import requests
-from supabase import create_client, Client
-
-# Load configuration from environment variables
-TWILIO_ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID")
-TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
-TWILIO_VERIFY_SERVICE_SID = os.environ.get("TWILIO_VERIFY_SERVICE_SID")
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
-SECRET_KEY = os.environ.get("SECRET_KEY", "changeme")  # For session middleware
+from fastapi.utils import is_body_allowed_for_status_code
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from starsessions import SessionAutoloadMiddleware, SessionMiddleware, get_session_id, regenerate_session_id
+from starsessions.stores.redis import RedisStore
+import httpx
+import orjson
+import phonenumbers
+from redis.asyncio import Redis
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+from postgrest.exceptions import APIError
+from pydantic import HttpUrl, SecretStr
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from supabase import acreate_client, AsyncClient
+from supabase.lib.client_options import AsyncClientOptions
+
+# Load configuration from environment variables (and .env); missing values stop the app at startup
+class Settings(BaseSettings):
+    """Typed application settings, validated once at import."""
+
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+    twilio_account_sid: str
+    twilio_auth_token: SecretStr
+    twilio_verify_service_sid: str
+    supabase_url: HttpUrl
+    supabase_service_key: SecretStr
+    supabase_db_url: Optional[str] = None  # Supavisor pooled connection (port 6543)
+    redis_url: str = "redis://localhost:6379/0"
+    app_env: Literal["development", "production"] = "development"  # "production": multi-worker `python main.py`
+
+settings = Settings()
+
+OTP_PENDING_TTL = 480  # Seconds a signup/sign-in waits for its OTP before it must be restarted
+OTP_MAX_ATTEMPTS = 5  # Code checks allowed per phone number within OTP_PENDING_TTL
+
+# Logging (debug lines are skipped unless the level is lowered)
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# Twilio Verify endpoints (relative to the client's base_url), built once at import
+TWILIO_SEND_PATH = f"Services/{settings.twilio_verify_service_sid}/Verifications"
+TWILIO_CHECK_PATH = f"Services/{settings.twilio_verify_service_sid}/VerificationCheck"
+
+# Shared Twilio HTTP client (HTTP/2, one multiplexed connection reused across requests)
+twilio_client = httpx.AsyncClient(
+    http2=True,
+    auth=(settings.twilio_account_sid, settings.twilio_auth_token.get_secret_value()),
+    base_url="https://verify.twilio.com/v2/",
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    timeout=10.0,
+)
+
+# Shared HTTP/2 client for Supabase: auth, PostgREST and storage reuse one connection pool to the same host
+supabase_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    timeout=10.0,
+)
+
+# Shared Redis connection pool (sessions, pending OTP state, OTP send throttling)
+redis_client = Redis.from_url(settings.redis_url)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the async Supabase client (and optional DB pool) on startup; close shared clients on shutdown."""
+    app.state.supabase = await acreate_client(
+        str(settings.supabase_url).rstrip("/"),
+        settings.supabase_service_key.get_secret_value(),
+        # Timeouts come from supabase_http; supabase-py ignores its *_client_timeout options when a client is passed
+        options=AsyncClientOptions(httpx_client=supabase_http),
+    )
+    # Small pool sized for Supabase's connection ceiling. Supavisor transaction mode can hand each statement to a
+    # different backend, so caches are off and every prepared statement gets a unique name (no __asyncpg_stmt_N__ clashes)
+    app.state.db_engine = create_async_engine(
+        settings.supabase_db_url,
+        pool_size=3,
+        max_overflow=2,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_timeout=30,
+        connect_args={
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        },
+    ) if settings.supabase_db_url else None
+    yield
+    if app.state.db_engine is not None:
+        await app.state.db_engine.dispose()
+    await twilio_client.aclose()
+    await supabase_http.aclose()
+    await redis_client.aclose()
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException) -> Response:
+    """Same as FastAPI's default HTTPException handler, but encodes the error body with orjson."""
+    headers = getattr(exc, "headers", None)
+    if not is_body_allowed_for_status_code(exc.status_code):
+        return Response(status_code=exc.status_code, headers=headers)
+    return Response(
+        orjson.dumps({"detail": exc.detail}),
+        status_code=exc.status_code,
+        media_type="application/json",
+        headers=headers,
+    )
+
+# Add session middleware (the cookie only carries a session ID; data lives in Redis)
+session_store = RedisStore(connection=redis_client)
+app.add_middleware(SessionAutoloadMiddleware)
+app.add_middleware(
+    SessionMiddleware,
+    store=session_store,
+    lifetime=7200,
+    cookie_https_only=True,
+)
+
+# Static files: serve precompressed .br/.gz sidecars when accepted, cache for a year (use content-hashed names)
+def parse_accept_encoding(header: str) -> dict:
+    """Map each content coding in an Accept-Encoding header to its q-value."""
+    qvalues = {}
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    return qvalues
 
-# Add session middleware
-app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that prefers `<file>.br` / `<file>.gz` sidecars and marks responses immutable."""
+
+    encodings = (("br", ".br"), ("gzip", ".gz"))
+    cache_control = "public, max-age=31536000, immutable"
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        response = None
+        if scope["method"] in ("GET", "HEAD"):
+            response = await self.sidecar_response(path, scope)
+        if response is None:
+            # Method checks (405), missing files (404) and directories are all handled by StaticFiles
+            response = await super().get_response(path, scope)
+        # Every variant of a URL must carry Vary so caches keep compressed and plain copies apart
+        response.headers["Vary"] = "Accept-Encoding"
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = self.cache_control
+        return response
+
+    async def sidecar_response(self, path: str, scope: Scope) -> Optional[Response]:
+        """Return the precompressed variant of an existing regular file, or None to serve it normally."""
+        _, original_stat = await anyio.to_thread.run_sync(self.lookup_path, path)
+        if not (original_stat and stat.S_ISREG(original_stat.st_mode)):
+            return None
+        request_headers = Headers(scope=scope)
+        qvalues = parse_accept_encoding(request_headers.get("accept-encoding", ""))
+        for encoding, suffix in self.encodings:
+            if qvalues.get(encoding, qvalues.get("*", 0)) <= 0:
+                continue
+            full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path + suffix)
+            if stat_result and stat.S_ISREG(stat_result.st_mode):
+                response = FileResponse(
+                    full_path,
+                    stat_result=stat_result,
+                    media_type=guess_type(path)[0] or "text/plain",
+                    headers={"Content-Encoding": encoding},
+                )
+                if self.is_not_modified(response.headers, request_headers):
+                    return NotModifiedResponse(response.headers)
+                return response
+        return None
 
 # Mount static files (if you add CSS or images)
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
+
+# Initialize Jinja2 templates (templates folder); compiled templates are cached on disk across restarts.
+# The default cache directory is private to the current user (mode 0700), so no one else can plant bytecode.
+# Templates are re-checked on disk only in development.
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader("templates"),
+    auto_reload=settings.app_env == "development",
+    bytecode_cache=FileSystemBytecodeCache(),
+    cache_size=400,
+    autoescape=True,
+))
+
+# Hot-path aliases: one global lookup in handlers instead of a global plus an attribute lookup
+_TR = templates.TemplateResponse
+_302 = status.HTTP_302_FOUND
 
-# Initialize Jinja2 templates (templates folder)
-templates = Jinja2Templates(directory="templates")
+# The anonymous home page never changes, so render it once and serve it with an ETag
+def render_anon_home() -> tuple:
+    """Render the signed-out home page; return (html bytes, strong ETag)."""
+    html = templates.get_template("home.html").render({"request": None, "user": None}).encode()
+    return html, f'"{hashlib.md5(html).hexdigest()}"'
 
-# Initialize Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+ANON_HOME_HTML, ANON_HOME_ETAG = render_anon_home()
+
+# Supabase client (created once in lifespan; override in tests via app.dependency_overrides)
+def get_supabase(request: Request) -> AsyncClient:
+    """Return the shared service-role Supabase client."""
+    return request.app.state.supabase
+
+def get_db_engine(request: Request) -> Optional[AsyncEngine]:
+    """Return the pooled Postgres engine, or None when SUPABASE_DB_URL is not set."""
+    return request.app.state.db_engine
 
 # ---------- Twilio Verify Helper Functions ----------
 
-def send_otp(phone_number: str):
+async def send_otp(phone_number: str):
     """Send OTP using Twilio Verify."""
-    url = f"https://verify.twilio.com/v2/Services/{TWILIO_VERIFY_SERVICE_SID}/Verifications"
     data = {
         'To': phone_number,
         'Channel': 'sms'
     }
-    response = requests.post(url, data=data, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
-    return response.json()
+    response = await twilio_client.post(TWILIO_SEND_PATH, data=data)
+    return orjson.loads(response.content)
 
-def verify_otp(phone_number: str, code: str):
+async def verify_otp(phone_number: str, code: str):
     """Verify OTP code using Twilio Verify."""
-    url = f"https://verify.twilio.com/v2/Services/{TWILIO_VERIFY_SERVICE_SID}/VerificationCheck"
     data = {
         'To': phone_number,
         'Code': code
     }
-    response = requests.post(url, data=data, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
-    return response.json()
+    response = await twilio_client.post(TWILIO_CHECK_PATH, data=data)
+    return orjson.loads(response.content)
+
+# ---------- Phone Number Helpers ----------
+
+def normalize_phone(phone: str) -> str:
+    """Return the phone number in E.164 format, or raise a 400 if it is not a valid number."""
+    try:
+        parsed = phonenumbers.parse(phone, None)
+    except phonenumbers.NumberParseException:
+        raise HTTPException(status_code=400, detail="Invalid phone number. Use international format, e.g. +1234567890.")
+    if not phonenumbers.is_valid_number(parsed):
+        raise HTTPException(status_code=400, detail="Invalid phone number. Use international format, e.g. +1234567890.")
+    return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
+
+# ---------- Rate Limiting ----------
+
+limiter = Limiter(key_func=get_remote_address, storage_uri=settings.redis_url)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
+async def check_otp_send_allowed(phone: str):
+    """Allow at most one OTP send per phone number every 30 seconds."""
+    if not await redis_client.set(f"otp_send:{phone}", 1, ex=30, nx=True):
+        raise HTTPException(status_code=429, detail="Please wait before requesting another code.")
+
+async def check_otp_attempt_allowed(phone: str):
+    """Allow at most OTP_MAX_ATTEMPTS code checks per phone number, however many flows are pending."""
+    key = f"otp_check:{phone}"
+    # INCR and EXPIRE NX in one MULTI/EXEC, so the counter can never be left without a TTL
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.incr(key)
+        pipe.expire(key, OTP_PENDING_TTL, nx=True)
+        attempts, _ = await pipe.execute()
+    if attempts > OTP_MAX_ATTEMPTS:
+        raise HTTPException(status_code=429, detail="Too many attempts. Please wait and request a new code.")
+
+# ---------- Pending OTP State ----------
+
+# Cookie names; each holds an opaque token pointing at a short-lived Redis key
+PENDING_USER_COOKIE = "pu"
+SIGNIN_PHONE_COOKIE = "sp"
+
+async def store_pending(response: Response, cookie_name: str, data: dict):
+    """Save pending OTP state in Redis with a TTL and point a cookie at it."""
+    token = secrets.token_urlsafe(16)
+    await redis_client.set(f"{cookie_name}:{token}", orjson.dumps(data), ex=OTP_PENDING_TTL)
+    response.set_cookie(cookie_name, token, max_age=OTP_PENDING_TTL, httponly=True, secure=True, samesite="lax")
+
+async def load_pending(request: Request, cookie_name: str, consume: bool = False):
+    """Return the pending OTP state for this request, or None if missing or expired.
+
+    With consume=True the Redis key is deleted atomically (GETDEL), so a flow can only complete once.
+    """
+    token = request.cookies.get(cookie_name)
+    if not token:
+        return None
+    key = f"{cookie_name}:{token}"
+    raw = await (redis_client.getdel(key) if consume else redis_client.get(key))
+    return orjson.loads(raw) if raw else None
+
+# ---------- OTP Flow Helpers ----------
+
+OTP_SENT_STATUSES = ("pending", "approved")
+
+async def start_otp_flow(cookie_name: str, pending: dict, verify_url: str) -> RedirectResponse:
+    """Throttle, send the OTP, then save the pending state and redirect to the verify page."""
+    phone = pending["phone"]
+    await check_otp_send_allowed(phone)
+    try:
+        otp_response = await send_otp(phone)
+    except Exception as e:
+        # Transport or decode errors from Twilio get the same clean 500 on /signup and /signin
+        log.error("Error sending OTP: %s", e)
+        otp_response = {}
+    if otp_response.get("status") not in OTP_SENT_STATUSES:
+        # Nothing was sent, so give the throttle slot back
+        await redis_client.delete(f"otp_send:{phone}")
+        raise HTTPException(status_code=500, detail="Failed to send OTP")
+    # Only a send Twilio accepted creates pending state
+    response = RedirectResponse(url=verify_url, status_code=_302)
+    await store_pending(response, cookie_name, pending)
+    return response
+
+async def verify_pending_otp(request: Request, cookie_name: str, otp: str, missing_detail: str) -> dict:
+    """Check the OTP for the pending flow, consume it and return its pending state."""
+    pending = await load_pending(request, cookie_name)
+    if not pending:
+        raise HTTPException(status_code=400, detail=missing_detail)
+    phone = pending["phone"]
+    await check_otp_attempt_allowed(phone)
+
+    try:
+        verify_result = await verify_otp(phone, otp)
+    except Exception as e:
+        # Transport or decode errors from Twilio: clean 500, pending state left intact for a retry
+        log.error("Error checking OTP: %s", e)
+        raise HTTPException(status_code=500, detail="Failed to verify OTP. Please try again.")
+    if verify_result.get("status") != "approved":
+        log.debug("Twilio verification failed: %s", verify_result)
+        raise HTTPException(status_code=400, detail="OTP verification failed. Please try again.")
+
+    # Consume the pending state so the same flow cannot complete twice
+    if not await load_pending(request, cookie_name, consume=True):
+        raise HTTPException(status_code=400, detail=missing_detail)
+    return pending
+
+def is_unique_violation(e: Exception) -> bool:
+    """True for a Postgres unique violation (SQLSTATE 23505) raised via PostgREST or SQLAlchemy."""
+    if isinstance(e, APIError):
+        return e.code == "23505"
+    if isinstance(e, IntegrityError):
+        return getattr(e.orig, "sqlstate", None) == "23505"
+    return False
+
+def clear_pending_headers(cookie_name: str) -> dict:
+    """Headers that expire the pending cookie, for errors raised after the flow was consumed."""
+    response = Response()
+    response.delete_cookie(cookie_name, httponly=True, secure=True, samesite="lax")
+    return {"set-cookie": response.headers["set-cookie"]}
+
+def finish_sign_in(request: Request, cookie_name: str, user: dict) -> RedirectResponse:
+    """Save the signed-in user in session, clear the pending cookie and redirect home."""
+    # New session ID on sign-in, so a session ID planted before sign-in never becomes authenticated
+    regenerate_session_id(request)
+    request.session["user"] = user
+    response = RedirectResponse(url="/", status_code=_302)
+    response.delete_cookie(cookie_name, httponly=True, secure=True, samesite="lax")
+    return response
 
 # ---------- Routes ----------
 
@@ -63,121 +393,110 @@ async def home(request: Request):
     Home page: if signed in, greet the user by name; otherwise show a welcome message.
     """
     user = request.session.get("user")
-    return templates.TemplateResponse("home.html", {"request": request, "user": user})
+    if user is None:
+        # In development, re-render so template edits show up (auto_reload) for signed-out visitors too
+        html, etag = render_anon_home() if settings.app_env == "development" else (ANON_HOME_HTML, ANON_HOME_ETAG)
+        # no-cache: browsers must revalidate, so they never show the anonymous page after sign-in
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Cookie"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(html, media_type="text/html", headers=headers)
+    return _TR(request, "home.html", {"user": user})
 
 @app.get("/signup", response_class=HTMLResponse)
 async def get_signup(request: Request):
     """Display the signup form for name and phone number."""
-    return templates.TemplateResponse("signup.html", {"request": request})
+    return _TR(request, "signup.html")
 
 @app.post("/signup")
+@limiter.limit("10/minute")
 async def post_signup(request: Request, name: str = Form(...), phone: str = Form(...)):
     """
     Process the signup form:
-      - Save pending user info (name and phone) in session.
+      - Save pending user info (name and phone) in Redis.
       - Trigger sending OTP via Twilio.
       - Redirect to /verify for OTP input.
     """
-    # Save pending user info in session
-    request.session["pending_user"] = {"name": name, "phone": phone}
-    # Send OTP via Twilio
-    otp_response = send_otp(phone)
-    if otp_response.get("status") not in ["pending", "approved"]:
-        raise HTTPException(status_code=500, detail="Failed to send OTP")
-    return RedirectResponse(url="/verify", status_code=status.HTTP_302_FOUND)
+    pending = {"name": name, "phone": normalize_phone(phone)}
+    return await start_otp_flow(PENDING_USER_COOKIE, pending, "/verify")
 
 @app.get("/verify", response_class=HTMLResponse)
 async def get_verify(request: Request):
     """Display the OTP verification form."""
-    pending = request.session.get("pending_user")
+    pending = await load_pending(request, PENDING_USER_COOKIE)
     if not pending:
         return RedirectResponse(url="/signup")
-    return templates.TemplateResponse("verify.html", {"request": request, "phone": pending["phone"]})
+    return _TR(request, "verify.html", {"phone": pending["phone"]})
 
 @app.post("/verify")
-async def post_verify(request: Request, otp: str = Form(...)):
+@limiter.limit("5/minute")
+async def post_verify(
+    request: Request,
+    otp: str = Form(...),
+    sb: AsyncClient = Depends(get_supabase),
+    db: Optional[AsyncEngine] = Depends(get_db_engine),
+):
     """
     Process OTP verification:
-      - Retrieve pending user info from session.
+      - Retrieve pending user info from Redis.
       - Verify OTP with Twilio.
-      - If successful, create the user in Supabase auth.
-      - Create a user profile in the database.
+      - If successful, create the Supabase auth user and profile (signup_user RPC).
       - Save the user info in session and redirect to home.
     """
-    pending = request.session.get("pending_user")
-    if not pending:
-        raise HTTPException(status_code=400, detail="No pending user found. Please sign up first.")
-
+    pending = await verify_pending_otp(
+        request, PENDING_USER_COOKIE, otp, "No pending user found. Please sign up first."
+    )
     phone = pending["phone"]
     name = pending["name"]
 
-    verify_result = verify_otp(phone, otp)
-    if verify_result.get("status") != "approved":
-        # Optionally: Log the actual Twilio error `verify_result` for debugging
-        raise HTTPException(status_code=400, detail="OTP verification failed. Please try again.")
-
     try:
-        # Step 1: Create the user in Supabase Auth
-        auth_response = supabase.auth.admin.create_user({
-            "phone": phone,
-            "phone_confirm": True,
-            "user_metadata": {"name": name}
-        })
-        
-        # Check if user creation was successful
-        if not auth_response or not auth_response.user:
-             raise Exception("Supabase user creation response was invalid.")
-        
-        created_user = auth_response.user
-        user_id = created_user.id
-        
-        # Step 2: Create a profile record in the profiles table
-        profile_data = {
-            "id": user_id,  # Use the same ID as the auth user
-            "name": name,
-            "phone": phone,
-            "created_at": "now()"  # Supabase SQL function for current timestamp
-        }
-        
-        # Insert the profile data
-        profile_response = supabase.table("profiles").insert(profile_data).execute()
-        
-        # Check for errors in the profile creation
-        if hasattr(profile_response, 'error') and profile_response.error:
-            print(f"Profile creation error: {profile_response.error}")
-            # Optionally: Roll back auth user creation if profile creation fails
-            # supabase.auth.admin.delete_user(user_id)
-            raise Exception(f"Failed to create user profile: {profile_response.error}")
+        # Create the auth user and its profile in one round-trip and one transaction
+        if db is not None:
+            async with db.begin() as conn:
+                result = await conn.execute(text("SELECT signup_user(:phone, :name)"), {"phone": phone, "name": name})
+                user_id = str(result.scalar_one())
+        else:
+            rpc_response = await sb.rpc("signup_user", {"p_phone": phone, "p_name": name}).execute()
+            user_id = rpc_response.data
+        if not user_id:
+            raise Exception("Supabase signup_user returned no user ID.")
 
     except Exception as e:
-        # Log the specific error for better debugging
-        print(f"Supabase Error: {e}")
-        raise HTTPException(status_code=500, detail="Error creating user in Supabase: " + str(e))
-
-    # Get user info to store in session
-    user_for_session = {
-        "id": user_id,
-        "name": name,
-        "phone": phone
-    }
+        if is_unique_violation(e):
+            # profiles_phone_uidx or the auth.users phone constraint: the phone is already registered
+            raise HTTPException(
+                status_code=409,
+                detail="An account with this phone number already exists. Please sign in.",
+                headers=clear_pending_headers(PENDING_USER_COOKIE),
+            )
+        # Log the specific error for debugging; the response stays generic (errors can embed SQL and bound values)
+        log.error("Supabase Error: %s", e)
+        raise HTTPException(
+            status_code=500,
+            detail="Error creating user in Supabase.",
+            headers=clear_pending_headers(PENDING_USER_COOKIE),
+        )
 
-    # Save the signed-in user in session and clear pending info
-    request.session["user"] = user_for_session
-    request.session.pop("pending_user", None)
-    return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
+    return finish_sign_in(request, PENDING_USER_COOKIE, {"id": user_id, "name": name, "phone": phone})
 
 @app.get("/signout")
 async def signout(request: Request):
     """Clear the session to sign the user out."""
-    request.session.pop("user", None)
-    return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
+    # Delete the old session from Redis explicitly, then continue under a fresh ID
+    old_session_id = get_session_id(request)
+    request.session.clear()
+    if old_session_id:
+        await session_store.remove(old_session_id)
+    regenerate_session_id(request)
+    return RedirectResponse(url="/", status_code=_302)
 
 @app.get("/signin", response_class=HTMLResponse)
 async def get_signin(request: Request):
     """Display the sign-in form for phone number input."""
-    return templates.TemplateResponse("signin.html", {"request": request})
+    return _TR(request, "signin.html")
 
 @app.post("/signin")
+@limiter.limit("10/minute")
 async def post_signin(request: Request, phone: str = Form(...)):
     """
     Process the sign-in form:
@@ -185,65 +504,41 @@ async def post_signin(request: Request, phone: str = Form(...)):
       - Send OTP via Twilio
       - Redirect to /signin/verify for OTP verification
     """
-    try:
-        # Store the phone in session for verification step
-        request.session["signin_phone"] = phone
-        
-        # Send OTP via Twilio
-        otp_response = send_otp(phone)
-        if otp_response.get("status") not in ["pending", "approved"]:
-            raise HTTPException(status_code=500, detail="Failed to send OTP")
-        
-        return RedirectResponse(url="/signin/verify", status_code=status.HTTP_302_FOUND)
-    except Exception as e:
-        print(f"Error in signin: {e}")
-        raise HTTPException(status_code=500, detail="Error during sign-in")
+    return await start_otp_flow(SIGNIN_PHONE_COOKIE, {"phone": normalize_phone(phone)}, "/signin/verify")
 
 @app.get("/signin/verify", response_class=HTMLResponse)
 async def get_signin_verify(request: Request):
     """Display the OTP verification form for sign-in."""
-    phone = request.session.get("signin_phone")
-    if not phone:
+    pending = await load_pending(request, SIGNIN_PHONE_COOKIE)
+    if not pending:
         return RedirectResponse(url="/signin")
-    return templates.TemplateResponse("signin_verify.html", {"request": request, "phone": phone})
+    return _TR(request, "signin_verify.html", {"phone": pending["phone"]})
 
 @app.post("/signin/verify")
-async def post_signin_verify(request: Request, otp: str = Form(...)):
+@limiter.limit("5/minute")
+async def post_signin_verify(request: Request, otp: str = Form(...), sb: AsyncClient = Depends(get_supabase)):
     """
     Process OTP verification for sign-in:
       - Verify OTP with Twilio
       - If successful, retrieve user from Supabase
       - Save user info in session and redirect to home
     """
-    phone = request.session.get("signin_phone")
-    if not phone:
-        raise HTTPException(status_code=400, detail="No phone number found. Please sign in first.")
-    
-    verify_result = verify_otp(phone, otp)
-    if verify_result.get("status") != "approved":
-        raise HTTPException(status_code=400, detail="OTP verification failed. Please try again.")
+    pending = await verify_pending_otp(
+        request, SIGNIN_PHONE_COOKIE, otp, "No phone number found. Please sign in first."
+    )
+    phone = pending["phone"]
     
     try:
         # Fetch user profile from database using the phone number
-        print(f"Searching for profile with phone: {phone}")
-        profile_response = supabase.table("profiles").select("*").eq("phone", phone).execute()
-        
-        # Log the raw response for debugging
-        print(f"Supabase response: {profile_response}")
-        print(f"Response data: {getattr(profile_response, 'data', 'No data attribute')}")
+        log.debug("Searching for profile with phone: %s", phone)
+        profile_response = await sb.table("profiles").select("id,name,phone").eq("phone", phone).single().execute()
         
-        # Check if we found a user
-        if not hasattr(profile_response, 'data') or not profile_response.data:
-            print(f"No profile data found for phone: {phone}")
-            raise HTTPException(status_code=404, detail="No user found with this phone number")
+        # Log the raw response for debugging (lazy %s args: repr only runs at DEBUG)
+        log.debug("Supabase response: %s", profile_response)
         
-        if len(profile_response.data) == 0:
-            print(f"Empty profile data array for phone: {phone}")
-            raise HTTPException(status_code=404, detail="No user found with this phone number")
-        
-        # Get the first matching user (should be only one)
-        user_profile = profile_response.data[0]
-        print(f"Found user profile: {user_profile}")
+        # .single() guarantees exactly one row (phone is unique)
+        user_profile = profile_response.data
+        log.debug("Found user profile: %s", user_profile)
         
         # Create session with user info
         user_for_session = {
@@ -252,20 +547,37 @@ async def post_signin_verify(request: Request, otp: str = Form(...)):
             "phone": user_profile.get("phone")
         }
         
-        print(f"Created session data: {user_for_session}")
-        
-        # Save the signed-in user in session and clear signin phone
-        request.session["user"] = user_for_session
-        request.session.pop("signin_phone", None)
+        log.debug("Created session data: %s", user_for_session)
         
-        return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
-    except HTTPException as he:
-        # Re-raise HTTP exceptions with the same status and detail
-        raise he
+        return finish_sign_in(request, SIGNIN_PHONE_COOKIE, user_for_session)
     except Exception as e:
-        print(f"Error in signin verification: {e}")
-        raise HTTPException(status_code=500, detail="Error during sign-in verification")
+        # PGRST116: the query did not return exactly one row
+        if isinstance(e, APIError) and e.code == "PGRST116":
+            log.info("No profile data found for phone: %s", phone)
+            raise HTTPException(
+                status_code=404,
+                detail="No user found with this phone number",
+                headers=clear_pending_headers(SIGNIN_PHONE_COOKIE),
+            )
+        log.error("Error in signin verification: %s", e)
+        raise HTTPException(
+            status_code=500,
+            detail="Error during sign-in verification",
+            headers=clear_pending_headers(SIGNIN_PHONE_COOKIE),
+        )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", reload=True)
+    if settings.app_env != "production":
+        # Local only: single worker with auto-reload
+        uvicorn.run("main:app", reload=True)
+    else:
+        # Production: one worker per core, uvloop + httptools, TLS/static handled by the reverse proxy
+        uvicorn.run(
+            "main:app",
+            workers=os.cpu_count() or 1,
+            loop="uvloop",
+            http="httptools",
+            access_log=False,
+            proxy_headers=True,
+        )